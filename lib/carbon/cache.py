@@ -12,7 +12,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
-from threading import Lock
+from threading import Lock, Event
 from carbon.conf import settings
 
 
@@ -20,6 +20,7 @@ class MetricCache(dict):
   def __init__(self):
     self.size = 0
     self.lock = Lock()
+    self.nonEmpty = Event()  # set when a datapoint is stored into an empty cache
 
   def __setitem__(self, key, value):
     raise TypeError("Use store() method instead!")
@@ -29,9 +30,13 @@ class MetricCache(dict):
       self.lock.acquire()
       self.setdefault(metric, []).append(datapoint)
       self.size += 1
+      wasEmpty = self.size == 1
     finally:
       self.lock.release()
 
+    if wasEmpty:
+      self.nonEmpty.set()
+
     if self.isFull():
       log.msg("MetricCache is full: self.size=%d" % self.size)
       state.events.cacheFull()
@@ -33,6 +33,7 @@ defaults = dict(
   MAX_CACHE_SIZE=float('inf'),
   MAX_UPDATES_PER_SECOND=500,
   MAX_CREATES_PER_MINUTE=float('inf'),
+  WRITER_THREADS=1,
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
@@ -46,7 +47,7 @@ defaults = dict(
   LOG_CACHE_HITS=True,
   WHISPER_AUTOFLUSH=False,
   WHISPER_SPARSE_CREATE=False,
-  WHISPER_FALLOCATE_CREATE=False,
+  WHISPER_FALLOCATE_CREATE=True,
   WHISPER_LOCK_WRITES=False,
   MAX_DATAPOINTS_PER_MESSAGE=500,
   MAX_AGGREGATION_INTERVALS=5,
@@ -221,15 +222,21 @@ class CarbonCacheOptions(usage.Options):
             print "Error: missing required config %s" % storage_schemas
             sys.exit(1)
 
+        # Without a writer thread datapoints would be cached but never written
+        if not isinstance(settings.WRITER_THREADS, int) or settings.WRITER_THREADS < 1:
+            print "Error: WRITER_THREADS must be an integer of at least 1, not %s" % settings.WRITER_THREADS
+            sys.exit(1)
+
         if settings.WHISPER_AUTOFLUSH:
             log.msg("Enabling Whisper autoflush")
             whisper.AUTOFLUSH = True
 
-        if settings.WHISPER_FALLOCATE_CREATE:
+        if settings.WHISPER_FALLOCATE_CREATE and not settings.WHISPER_SPARSE_CREATE:
             if whisper.CAN_FALLOCATE:
                 log.msg("Enabling Whisper fallocate support")
             else:
-                log.err("WHISPER_FALLOCATE_CREATE is enabled but linking failed.")
+                log.msg("WHISPER_FALLOCATE_CREATE is enabled but fallocate is unavailable, "
+                        "new files will be zero-filled instead.")
 
         if settings.WHISPER_LOCK_WRITES:
             if whisper.CAN_LOCK:
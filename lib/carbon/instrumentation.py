@@ -1,6 +1,7 @@
 import os
 import time
 import socket
+from threading import Lock
 from resource import getrusage, RUSAGE_SELF
 
 from twisted.application.service import Service
@@ -9,6 +10,7 @@ from carbon.conf import settings
 
 
 stats = {}
+statsLock = Lock()  # stats are updated from the writer threads too
 prior_stats = {}
 HOSTNAME = socket.gethostname().replace('.','_')
 PAGESIZE = os.sysconf('SC_PAGESIZE')
@@ -26,22 +28,44 @@ lastUsageTime = time.time()
 
 def increment(stat, increase=1):
   try:
-    stats[stat] += increase
-  except KeyError:
-    stats[stat] = increase
+    statsLock.acquire()
+    try:
+      stats[stat] += increase
+    except KeyError:
+      stats[stat] = increase
+  finally:
+    statsLock.release()
 
 def max(stat, newval):
   try:
-    if stats[stat] < newval:
+    statsLock.acquire()
+    try:
+      if stats[stat] < newval:
+        stats[stat] = newval
+    except KeyError:
       stats[stat] = newval
-  except KeyError:
-    stats[stat] = newval
+  finally:
+    statsLock.release()
 
 def append(stat, value):
   try:
-    stats[stat].append(value)
-  except KeyError:
-    stats[stat] = [value]
+    statsLock.acquire()
+    try:
+      stats[stat].append(value)
+    except KeyError:
+      stats[stat] = [value]
+  finally:
+    statsLock.release()
+
+def extend(stat, values):
+  try:
+    statsLock.acquire()
+    try:
+      stats[stat].extend(values)
+    except KeyError:
+      stats[stat] = list(values)
+  finally:
+    statsLock.release()
 
 
 def getCpuUsage():
@@ -73,9 +97,13 @@ def getMemUsage():
 def recordMetrics():
   global lastUsage
   global prior_stats
-  myStats = stats.copy()
+  try:
+    statsLock.acquire()
+    myStats = stats.copy()
+    stats.clear()
+  finally:
+    statsLock.release()
   myPriorStats = {}
-  stats.clear()
 
   # cache metrics
   if settings.program == 'carbon-cache':
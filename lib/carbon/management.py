@@ -1,4 +1,3 @@
-import traceback
 import whisper
 from carbon import log
 from carbon.storage import getFilesystemPath
@@ -13,9 +12,9 @@ def getMetadata(metric, key):
   try:
     value = whisper.info(wsp_path)['aggregationMethod']
     return dict(value=value)
-  except:
+  except Exception as e:
     log.err()
-    return dict(error=traceback.format_exc())
+    return dict(error="%s: %s" % (e.__class__.__name__, e))
 
 
 def setMetadata(metric, key, value):
@@ -26,6 +25,6 @@ def setMetadata(metric, key, value):
   try:
     old_value = whisper.setAggregationMethod(wsp_path, value)
     return dict(old_value=old_value, new_value=value)
-  except:
+  except Exception as e:
     log.err()
-    return dict(error=traceback.format_exc())
+    return dict(error="%s: %s" % (e.__class__.__name__, e))
@@ -26,9 +26,31 @@ STORAGE_SCHEMAS_CONFIG = join(settings.CONF_DIR, 'storage-schemas.conf')
 STORAGE_AGGREGATION_CONFIG = join(settings.CONF_DIR, 'storage-aggregation.conf')
 STORAGE_LISTS_DIR = join(settings.CONF_DIR, 'lists')
 
+# Paths are requested for the same metrics over and over, so remember them
+# (per data directory, in case LOCAL_DATA_DIR changes after a config reload).
+# Junk metrics and metadata lookups can ask for any name, so the cache is
+# simply emptied whenever it outgrows PATH_CACHE_SIZE. A full cache holds
+# about 20MB, a bigger one would save the rate limited writer little.
+PATH_CACHE_SIZE = 1 << 16
+pathCache = {}
+pathCacheState = (None, None)  # (data dir, its path prefix), replaced as a whole
+
 def getFilesystemPath(metric):
-  metric_path = metric.replace('.',sep).lstrip(sep) + '.wsp'
-  return join(settings.LOCAL_DATA_DIR, metric_path)
+  global pathCacheState
+  dataDir, pathPrefix = pathCacheState
+  if dataDir != settings.LOCAL_DATA_DIR:
+    dataDir = settings.LOCAL_DATA_DIR
+    pathPrefix = join(dataDir, '')  # with a trailing separator
+    pathCache.clear()
+    pathCacheState = (dataDir, pathPrefix)
+
+  try:
+    return pathCache[metric]
+  except KeyError:
+    if len(pathCache) >= PATH_CACHE_SIZE:
+      pathCache.clear()
+    path = pathCache[metric] = pathPrefix + metric.replace('.',sep).lstrip(sep) + '.wsp'
+    return path
 
 
 class Schema:
@@ -137,6 +159,7 @@ def loadStorageSchemas():
 
     try:
       whisper.validateArchiveList(archiveList)
+      mySchema.archiveConfig = tuple(archiveList)
       schemaList.append(mySchema)
     except whisper.InvalidConfiguration, e:
       log.msg("Invalid schemas found in %s: %s" % (section, e) )
@@ -192,4 +215,5 @@ def loadAggregationSchemas():
 
 defaultArchive = Archive(60, 60 * 24 * 7) #default retention for unclassified data (7 days of minutely data)
 defaultSchema = DefaultSchema('default', [defaultArchive])
+defaultSchema.archiveConfig = (defaultArchive.getTuple(),)
 defaultAggregation = DefaultSchema('default', (None, None))
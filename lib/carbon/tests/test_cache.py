@@ -0,0 +1,27 @@
+import unittest
+from carbon.cache import MetricCache
+
+
+class MetricCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # MetricCache is a module-level instance, make a fresh one of its class
+        self.cache = type(MetricCache)()
+
+    def test_store_into_empty_cache_sets_non_empty(self):
+        self.assertFalse(self.cache.nonEmpty.isSet())
+        self.cache.store('foo', (1, 1.0))
+        self.assertTrue(self.cache.nonEmpty.isSet())
+
+    def test_store_into_non_empty_cache_leaves_event_alone(self):
+        self.cache.store('foo', (1, 1.0))
+        self.cache.nonEmpty.clear()
+        self.cache.store('bar', (1, 1.0))
+        self.assertFalse(self.cache.nonEmpty.isSet())
+
+    def test_store_after_drain_sets_non_empty(self):
+        self.cache.store('foo', (1, 1.0))
+        self.cache.pop('foo')
+        self.cache.nonEmpty.clear()
+        self.cache.store('foo', (2, 2.0))
+        self.assertTrue(self.cache.nonEmpty.isSet())
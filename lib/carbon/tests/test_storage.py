@@ -0,0 +1,42 @@
+import unittest
+from carbon import conf
+
+# carbon.storage resolves its config paths at import time
+conf.settings.setdefault('CONF_DIR', '')
+conf.settings.setdefault('WHITELISTS_DIR', '')
+
+from carbon import storage
+from carbon.storage import getFilesystemPath
+
+
+class FilesystemPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = conf.settings.get('LOCAL_DATA_DIR')
+        self.cache_size = storage.PATH_CACHE_SIZE
+        conf.settings['LOCAL_DATA_DIR'] = '/data/whisper'
+
+    def tearDown(self):
+        storage.PATH_CACHE_SIZE = self.cache_size
+        if self.data_dir is None:
+            del conf.settings['LOCAL_DATA_DIR']
+        else:
+            conf.settings['LOCAL_DATA_DIR'] = self.data_dir
+
+    def test_path(self):
+        self.assertEqual(getFilesystemPath('carbon.agents.a.cpuUsage'),
+                         '/data/whisper/carbon/agents/a/cpuUsage.wsp')
+        self.assertEqual(getFilesystemPath('.leading.dot'),
+                         '/data/whisper/leading/dot.wsp')
+
+    def test_data_dir_change_invalidates_cache(self):
+        getFilesystemPath('foo.bar')
+        conf.settings['LOCAL_DATA_DIR'] = '/other/'
+        self.assertEqual(getFilesystemPath('foo.bar'), '/other/foo/bar.wsp')
+
+    def test_cache_is_bounded(self):
+        storage.PATH_CACHE_SIZE = 10
+        for i in range(25):
+            self.assertEqual(getFilesystemPath('junk.%d' % i),
+                             '/data/whisper/junk/%d.wsp' % i)
+            self.assertTrue(len(storage.pathCache) <= 10)
@@ -0,0 +1,90 @@
+import unittest
+from carbon import util
+from carbon.util import TokenBucket
+
+
+class FakeTime(object):
+
+    def __init__(self, now):
+        self.now = now
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime(1000.0)
+        self.real_time = util.time
+        util.time = self.clock
+
+    def tearDown(self):
+        util.time = self.real_time
+
+    def test_starts_full(self):
+        bucket = TokenBucket(10, 5)
+        self.assertEqual(bucket.tokens, 10)
+        self.assertTrue(bucket.drain(10))
+        self.assertFalse(bucket.drain(1))
+
+    def test_refills_at_fill_rate(self):
+        bucket = TokenBucket(10, 5)
+        bucket.drain(10)
+        self.clock.now += 1
+        self.assertEqual(bucket.tokens, 5)
+        self.clock.now += 60
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_refills_after_idle_period(self):
+        """Draining after an idle period must not refill from a stale timestamp"""
+        bucket = TokenBucket(10, 5)
+        self.clock.now += 60
+        for i in range(10):
+            self.assertTrue(bucket.drain(1))
+        self.assertFalse(bucket.drain(1))
+
+    def test_blocking_drain_sleeps_for_the_deficit(self):
+        bucket = TokenBucket(10, 5)
+        bucket.drain(10)
+        self.clock.now += 0.1
+        self.assertTrue(bucket.drain(2, blocking=True))
+        self.assertEqual(len(self.clock.slept), 1)
+        self.assertAlmostEqual(self.clock.slept[0], 0.3)
+        self.assertAlmostEqual(bucket.tokens, 0)
+
+    def test_drain_with_given_timestamp(self):
+        bucket = TokenBucket(10, 5)
+        bucket.drain(10)
+        self.assertFalse(bucket.drain(1))
+        self.assertTrue(bucket.drain(1, now=self.clock.now + 0.2))
+        self.assertEqual(bucket.timestamp, self.clock.now + 0.2)
+
+    def test_stale_timestamps_are_not_credited_twice(self):
+        """Writer threads read the clock before taking the bucket's lock, so
+        their timestamps can arrive out of order"""
+        bucket = TokenBucket(10, 10)
+        self.clock.now += 1
+        bucket.drain(10, now=self.clock.now)
+        self.assertFalse(bucket.drain(1, now=self.clock.now - 0.5))
+        self.assertFalse(bucket.drain(5, now=self.clock.now))
+        self.assertEqual(bucket.timestamp, self.clock.now)
+
+        self.clock.now += 0.2
+        self.assertTrue(bucket.drain(2, now=self.clock.now))
+        self.assertFalse(bucket.drain(1, now=self.clock.now - 0.1))
+        self.assertFalse(bucket.drain(1, now=self.clock.now))
+        self.assertAlmostEqual(bucket.tokens, 0)
+
+    def test_clock_stepping_backwards(self):
+        bucket = TokenBucket(10, 5)
+        bucket.drain(10)
+        self.clock.now -= 30
+        self.assertEqual(bucket.tokens, 0)
+        self.clock.now += 1
+        self.assertEqual(bucket.tokens, 5)
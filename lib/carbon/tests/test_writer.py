@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from os.path import dirname, join
+
+import whisper
+from carbon import conf
+
+# carbon.storage resolves its config paths at import time, and carbon.writer
+# loads the schemas as soon as it is imported
+conf.settings.setdefault('CONF_DIR', '')
+conf.settings.setdefault('WHITELISTS_DIR', '')
+
+from carbon import storage
+EXAMPLE_CONF_DIR = join(dirname(__file__), '..', '..', '..', 'conf')
+storage.STORAGE_SCHEMAS_CONFIG = join(EXAMPLE_CONF_DIR, 'storage-schemas.conf.example')
+storage.STORAGE_AGGREGATION_CONFIG = join(EXAMPLE_CONF_DIR, 'storage-aggregation.conf.example')
+
+from carbon import writer, instrumentation
+from carbon.cache import MetricCache
+
+
+class TickingTime(object):
+    "A clock that moves a second forward every time it is read"
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+
+class WriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.settings = dict(conf.settings)
+        conf.settings['LOCAL_DATA_DIR'] = self.data_dir
+        conf.settings['LOG_UPDATES'] = False
+        writer.knownDbFiles.clear()
+        writer.createCount = 0
+        writer.lastCreateInterval = 0
+        instrumentation.stats.clear()
+        self.clearCache()
+
+    def tearDown(self):
+        self.clearCache()
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+        shutil.rmtree(self.data_dir)
+
+    def clearCache(self):
+        for metric in list(MetricCache):
+            MetricCache.pop(metric)
+
+
+class WriteCachedDataPointsTest(WriterTestCase):
+
+    def test_recreates_deleted_file_quietly(self):
+        now = int(time.time())
+        MetricCache.store('servers.web1.load', (now - 60, 1.0))
+        writer.writeCachedDataPoints()
+        path = storage.getFilesystemPath('servers.web1.load')
+        self.assertTrue('servers.web1.load' in writer.knownDbFiles)
+
+        # A cleanup job removes the file between passes
+        os.unlink(path)
+        MetricCache.store('servers.web1.load', (now, 2.0))
+        writer.writeCachedDataPoints()
+
+        self.assertFalse(MetricCache)
+        self.assertEqual(whisper.fetch(path, now - 120)[1][-1], 2.0)
+        self.assertEqual(instrumentation.stats.get('errors', 0), 0)
+        self.assertEqual(instrumentation.stats['creates'], 2)
+
+    def test_known_db_files_is_bounded(self):
+        size = writer.KNOWN_DB_FILES_SIZE
+        writer.KNOWN_DB_FILES_SIZE = 3
+        try:
+            for i in range(7):
+                MetricCache.store('servers.web%d.load' % i, (int(time.time()), 1.0))
+            writer.writeCachedDataPoints()
+            self.assertTrue(len(writer.knownDbFiles) <= 3)
+        finally:
+            writer.KNOWN_DB_FILES_SIZE = size
+
+
+    def test_update_stats_are_flushed(self):
+        now = int(time.time())
+        MetricCache.store('servers.web1.load', (now - 60, 1.0))
+        MetricCache.store('servers.web1.load', (now, 2.0))
+        MetricCache.store('servers.web2.load', (now, 3.0))
+        writer.writeCachedDataPoints()
+        self.assertEqual(instrumentation.stats['committedPoints'], 3)
+        self.assertEqual(len(instrumentation.stats['updateTimes']), 2)
+
+    def test_update_stats_are_flushed_every_second(self):
+        for i in range(3):
+            MetricCache.store('servers.web%d.load' % i, (int(time.time()), 1.0))
+        flushes = []
+        extend = instrumentation.extend
+        def recordingExtend(stat, values):
+            flushes.append(len(values))
+            extend(stat, values)
+        instrumentation.extend = recordingExtend
+        writer.time = TickingTime()
+        try:
+            writer.writeCachedDataPoints()
+        finally:
+            instrumentation.extend = extend
+            writer.time = time
+        self.assertEqual(flushes, [1, 1, 1, 0])
+        self.assertEqual(instrumentation.stats['committedPoints'], 3)
+
+    def test_update_stats_are_flushed_when_the_drain_fails(self):
+        now = int(time.time())
+        MetricCache.store('carbon.agents.a.cpuUsage', (now - 60, 1.0))
+        MetricCache.store('carbon.agents.a.cpuUsage', (now, 2.0))
+        MetricCache.store('servers.web1.load', (now, 3.0))
+        schemas = writer.schemas
+        writer.schemas = [schema for schema in schemas if schema.name == 'carbon']
+        try:
+            self.assertRaises(Exception, writer.writeCachedDataPoints)
+        finally:
+            writer.schemas = schemas
+        self.assertEqual(instrumentation.stats['committedPoints'], 2)
+        self.assertEqual(len(instrumentation.stats['updateTimes']), 1)
+
+class UpdateBucketTest(WriterTestCase):
+
+    def setUp(self):
+        WriterTestCase.setUp(self)
+        self.updateBucket = writer.updateBucket
+
+    def tearDown(self):
+        writer.updateBucket = self.updateBucket
+        WriterTestCase.tearDown(self)
+
+    def test_rates_below_one_allow_one_update_per_second(self):
+        for rate in (0, -1, 0.5):
+            bucket = writer.makeUpdateBucket(rate)
+            self.assertEqual((bucket.capacity, bucket.fill_rate), (1, 1))
+
+    def test_zero_shutdown_rate_does_not_stop_updates(self):
+        conf.settings['MAX_UPDATES_PER_SECOND_ON_SHUTDOWN'] = 0
+        writer.shutdownModifyUpdateSpeed()
+        self.assertEqual(writer.updateBucket.fill_rate, 1)
+        self.assertTrue(writer.updateBucket.drain(1, blocking=True))
+
+
+class ShardedWriterTest(WriterTestCase):
+
+    def storeMetrics(self, count):
+        metrics = ['servers.web%d.load' % i for i in range(count)]
+        for metric in metrics:
+            MetricCache.store(metric, (int(time.time()), 1.0))
+        return metrics
+
+    def test_shards_split_the_cache(self):
+        metrics = self.storeMetrics(20)
+        seen = []
+        for shard in range(3):
+            for (metric, datapoints, path, exists) in writer.optimalWriteOrder(shard, 3):
+                self.assertEqual(hash(metric) % 3, shard)
+                seen.append(metric)
+        self.assertEqual(sorted(seen), sorted(metrics))
+        self.assertFalse(MetricCache)
+
+    def test_create_limit_is_shared_across_shards(self):
+        conf.settings['MAX_CREATES_PER_MINUTE'] = 5
+        self.storeMetrics(20)
+        expected = len(list(writer.optimalWriteOrder()))
+
+        writer.createCount = 0
+        writer.lastCreateInterval = 0
+        self.storeMetrics(20)
+        created = 0
+        for shard in range(3):
+            created += len(list(writer.optimalWriteOrder(shard, 3)))
+        self.assertTrue(0 < expected < 20)
+        self.assertEqual(created, expected)
+
+    def test_drained_shard_returns_while_others_have_data(self):
+        metrics = self.storeMetrics(20)
+        writer.writeCachedDataPoints(0, 2)
+        self.assertEqual(sorted(MetricCache),
+                         sorted(m for m in metrics if hash(m) % 2 == 1))
+
+
+class ReloadStorageSchemasTest(WriterTestCase):
+
+    def setUp(self):
+        WriterTestCase.setUp(self)
+        self.config = join(self.data_dir, 'storage-schemas.conf')
+        self.paths = (storage.STORAGE_SCHEMAS_CONFIG, writer.STORAGE_SCHEMAS_CONFIG)
+        self.state = (writer.schemas, writer.schemasStamp)
+        storage.STORAGE_SCHEMAS_CONFIG = writer.STORAGE_SCHEMAS_CONFIG = self.config
+
+    def tearDown(self):
+        storage.STORAGE_SCHEMAS_CONFIG, writer.STORAGE_SCHEMAS_CONFIG = self.paths
+        writer.schemas, writer.schemasStamp = self.state
+        WriterTestCase.tearDown(self)
+
+    def writeConfig(self, retentions, mtime):
+        fh = open(self.config, 'w')
+        fh.write("[everything]\npattern = .*\nretentions = %s\n" % retentions)
+        fh.close()
+        os.utime(self.config, (mtime, mtime))
+
+    def test_unchanged_file_is_not_reloaded(self):
+        self.writeConfig('60s:1d', time.time() - 10)
+        writer.reloadStorageSchemas()
+        schemas = writer.schemas
+        writer.reloadStorageSchemas()
+        self.assertTrue(writer.schemas is schemas)
+
+    def test_edit_within_the_same_second_is_reloaded(self):
+        mtime = int(time.time()) - 10
+        self.writeConfig('60s:1d', mtime)
+        writer.reloadStorageSchemas()
+        self.writeConfig('10s:1d,60s:7d', mtime)
+        writer.reloadStorageSchemas()
+        self.assertEqual(writer.schemas[0].archiveConfig, ((10, 8640), (60, 10080)))
+
+    def test_freshly_written_file_is_always_reloaded(self):
+        self.writeConfig('60s:1d', time.time())
+        writer.reloadStorageSchemas()
+        schemas = writer.schemas
+        writer.reloadStorageSchemas()
+        self.assertFalse(writer.schemas is schemas)
@@ -1,7 +1,9 @@
 import sys
 import os
 import pwd
+import time
 
+from threading import Lock
 from os.path import abspath, basename, dirname, join
 try:
   from cStringIO import StringIO
@@ -162,3 +164,60 @@ def get_unpickler(insecure=False):
     return pickle
   else:
     return SafeUnpickler
+
+
+class TokenBucket(object):
+  """A token bucket rate limiter. The bucket holds at most `capacity` tokens
+  and is refilled continuously at `fill_rate` tokens per second."""
+
+  def __init__(self, capacity, fill_rate):
+    self.capacity = float(capacity)
+    self.fill_rate = float(fill_rate)
+    self._tokens = self.capacity
+    self.timestamp = time.time()
+    self.lock = Lock()
+
+  @property
+  def tokens(self):
+    return self.refill(time.time())
+
+  def refill(self, now):
+    if now < self.timestamp:
+      # Either a caller's timestamp was taken before another caller's, which
+      # must not credit the same interval twice, or the wall clock really
+      # stepped backwards, which must not stall the bucket until it catches up
+      current = time.time()
+      if current < self.timestamp:
+        self.timestamp = current
+      return self._tokens
+
+    self._tokens = min(self.capacity, self._tokens + (now - self.timestamp) * self.fill_rate)
+    self.timestamp = now
+    return self._tokens
+
+  def drain(self, cost, blocking=False, now=None):
+    """Takes `cost` tokens out of the bucket and returns True if there are
+    enough of them. Otherwise returns False and leaves the bucket alone, or
+    with `blocking` sleeps just long enough for the deficit to refill.
+    Callers that have just read the clock can pass it as `now`."""
+    if now is None:
+      now = time.time()
+
+    try:
+      self.lock.acquire()
+      tokens = self.refill(now)
+      if cost <= tokens:
+        self._tokens -= cost
+        return True
+
+      if not blocking:
+        return False
+
+      # Reserve the tokens before sleeping so concurrent callers queue up
+      # behind us; the refill accrued while sleeping pays the deficit back.
+      self._tokens -= cost
+    finally:
+      self.lock.release()
+
+    time.sleep((cost - tokens) / self.fill_rate)
+    return True
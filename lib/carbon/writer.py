@@ -15,15 +15,18 @@ limitations under the License."""
 
 import os
 import time
-from os.path import exists, dirname
+from os.path import exists, dirname, isdir
 import errno
+from operator import itemgetter
+from threading import Lock
 
 import whisper
 from carbon import state
 from carbon.cache import MetricCache
 from carbon.storage import getFilesystemPath, loadStorageSchemas,\
-    loadAggregationSchemas
+    loadAggregationSchemas, STORAGE_SCHEMAS_CONFIG, STORAGE_AGGREGATION_CONFIG
 from carbon.conf import settings
+from carbon.util import TokenBucket
 from carbon import log, events, instrumentation
 
 from twisted.internet import reactor
@@ -33,20 +36,57 @@ from twisted.application.service import Service
 
 lastCreateInterval = 0
 createCount = 0
+createLock = Lock()  # guards the two counters above across writer threads
+knownDbFiles = set()  # metrics whose database file was written to successfully
+KNOWN_DB_FILES_SIZE = 1 << 16  # emptied past this, an emptied set only costs a stat per metric
+
+
+def getConfigStamp(path):
+  """Returns what identifies the current contents of a config file, so that
+  unchanged files need not be reloaded."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+
+  if time.time() - st.st_mtime < 1:
+    # Filesystems with 1 second mtimes can't tell apart edits made within the
+    # same second, so a freshly written file never compares as unchanged
+    return object()
+
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+
+# Schemas are only reloaded when their config file changes
+schemasStamp = getConfigStamp(STORAGE_SCHEMAS_CONFIG)
 schemas = loadStorageSchemas()
+agg_schemasStamp = getConfigStamp(STORAGE_AGGREGATION_CONFIG)
 agg_schemas = loadAggregationSchemas()
 CACHE_SIZE_LOW_WATERMARK = settings.MAX_CACHE_SIZE * 0.95
 
 
-def optimalWriteOrder():
+def makeUpdateBucket(rate):
+  "Returns a bucket limiting whisper updates to `rate` per second"
+  # Rates below 1 have always meant one update per second rather than none
+  rate = max(rate, 1)
+  return TokenBucket(rate, rate)
+
+
+updateBucket = makeUpdateBucket(settings.MAX_UPDATES_PER_SECOND)
+
+
+def optimalWriteOrder(shard=0, shards=1):
   """Generates metrics with the most cached values first and applies a soft
-  rate limit on new metrics"""
+  rate limit on new metrics. With several writer threads each one only
+  handles the metrics that hash to its own shard."""
   global lastCreateInterval
   global createCount
   metrics = MetricCache.counts()
+  if shards > 1:
+    metrics = [item for item in metrics if hash(item[0]) % shards == shard]
 
   t = time.time()
-  metrics.sort(key=lambda item: item[1], reverse=True)  # by queue size, descending
+  metrics.sort(key=itemgetter(1), reverse=True)  # by queue size, descending
   log.debug("Sorted %d cache queues in %.6f seconds" % (len(metrics),
                                                         time.time() - t))
 
@@ -55,17 +95,24 @@ def optimalWriteOrder():
       events.cacheSpaceAvailable()
 
     dbFilePath = getFilesystemPath(metric)
-    dbFileExists = exists(dbFilePath)
+    dbFileExists = metric in knownDbFiles or exists(dbFilePath)
 
     if not dbFileExists:
-      createCount += 1
-      now = time.time()
-
-      if now - lastCreateInterval >= 60:
-        lastCreateInterval = now
-        createCount = 1
+      try:
+        createLock.acquire()
+        createCount += 1
+        now = time.time()
+
+        if now - lastCreateInterval >= 60:
+          lastCreateInterval = now
+          createCount = 1
+          overLimit = False
+        else:
+          overLimit = createCount >= settings.MAX_CREATES_PER_MINUTE
+      finally:
+        createLock.release()
 
-      elif createCount >= settings.MAX_CREATES_PER_MINUTE:
+      if overLimit:
         # dropping queued up datapoints for new metrics prevents filling up the entire cache
         # when a bunch of new metrics are received.
         try:
@@ -84,111 +131,153 @@ def optimalWriteOrder():
     yield (metric, datapoints, dbFilePath, dbFileExists)
 
 
-def writeCachedDataPoints():
-  "Write datapoints until the MetricCache is completely empty"
-  updates = 0
-  lastSecond = 0
-
-  while MetricCache:
-    dataWritten = False
-
-    for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder():
-      dataWritten = True
-
-      if not dbFileExists:
-        archiveConfig = None
-        xFilesFactor, aggregationMethod = None, None
-
-        for schema in schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched schema %s' % (metric, schema.name))
-            archiveConfig = [archive.getTuple() for archive in schema.archives]
-            break
+def writeCachedDataPoints(shard=0, shards=1):
+  "Write datapoints until the MetricCache has nothing left for this shard"
+  # Per-update stats are collected locally and handed to instrumentation about
+  # once a second, rather than on every update
+  committedPoints, updateTimes = 0, []
+  lastFlush = time.time()
 
-        for schema in agg_schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
-            xFilesFactor, aggregationMethod = schema.archives
-            break
-
-        if not archiveConfig:
-          raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+  try:
+    while MetricCache:
+      dataWritten = False
+
+      for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder(shard, shards):
+        dataWritten = True
+
+        if not dbFileExists:
+          archiveConfig = None
+          xFilesFactor, aggregationMethod = None, None
+
+          for schema in schemas:
+            if schema.matches(metric):
+              log.creates('new metric %s matched schema %s' % (metric, schema.name))
+              archiveConfig = list(schema.archiveConfig)  # whisper sorts this in place
+              break
+
+          for schema in agg_schemas:
+            if schema.matches(metric):
+              log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
+              xFilesFactor, aggregationMethod = schema.archives
+              break
+
+          if not archiveConfig:
+            raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+
+          # New metrics usually land in directories that already exist, so check
+          # first rather than paying for makedirs() failing with EEXIST
+          dbDir = dirname(dbFilePath)
+          if not isdir(dbDir):
+            try:
+              os.makedirs(dbDir)
+            except OSError as e:
+              if e.errno != errno.EEXIST:
+                log.err("%s" % e)
+          log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
+                      (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
+          # whisper prefers fallocate over sparse files, but an explicit sparse setting should win
+          useFallocate = settings.WHISPER_FALLOCATE_CREATE and not settings.WHISPER_SPARSE_CREATE
+          whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, useFallocate)
+          instrumentation.increment('creates')
 
-        dbDir = dirname(dbFilePath)
         try:
-          os.makedirs(dbDir)
-        except OSError as e:
-          if e.errno != errno.EEXIST:
-            log.err("%s" % e)
-        log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
-                    (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
-        whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
-        instrumentation.increment('creates')
-
-      try:
-        t1 = time.time()
-        whisper.update_many(dbFilePath, datapoints)
-        t2 = time.time()
-        updateTime = t2 - t1
-      except:
-        log.msg("Error writing to %s" % (dbFilePath))
-        log.err()
-        instrumentation.increment('errors')
-      else:
-        pointCount = len(datapoints)
-        instrumentation.increment('committedPoints', pointCount)
-        instrumentation.append('updateTimes', updateTime)
-
-        if settings.LOG_UPDATES:
-          log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
-
-        # Rate limit update operations
-        thisSecond = int(t2)
-
-        if thisSecond != lastSecond:
-          lastSecond = thisSecond
-          updates = 0
+          t1 = time.time()
+          whisper.update_many(dbFilePath, datapoints)
+          t2 = time.time()
+          updateTime = t2 - t1
+        except:
+          knownDbFiles.discard(metric)
+
+          if not exists(dbFilePath):
+            # The file was removed out from under us (e.g. by a cleanup job),
+            # quietly requeue so the next pass recreates it like any new metric
+            for datapoint in datapoints:
+              MetricCache.store(metric, datapoint)
+          else:
+            log.msg("Error writing to %s" % (dbFilePath))
+            log.err()
+            instrumentation.increment('errors')
         else:
-          updates += 1
-          if updates >= settings.MAX_UPDATES_PER_SECOND:
-            time.sleep(int(t2 + 1) - t2)
-
-    # Avoid churning CPU when only new metrics are in the cache
-    if not dataWritten:
-      time.sleep(0.1)
-
-
-def writeForever():
+          if len(knownDbFiles) >= KNOWN_DB_FILES_SIZE:
+            knownDbFiles.clear()
+          knownDbFiles.add(metric)
+          pointCount = len(datapoints)
+          committedPoints += pointCount
+          updateTimes.append(updateTime)
+
+          if settings.LOG_UPDATES:
+            log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
+
+          # Rate limit update operations, reusing the timestamp taken above
+          updateBucket.drain(1, blocking=True, now=t2)
+
+          if t2 - lastFlush >= 1:
+            instrumentation.increment('committedPoints', committedPoints)
+            instrumentation.extend('updateTimes', updateTimes)
+            committedPoints, updateTimes = 0, []
+            lastFlush = t2
+
+      # Other shards keep the cache non-empty, so stop once a pass finds nothing
+      # of ours and let writeForever() decide how long to wait
+      if not dataWritten:
+        break
+  finally:
+    instrumentation.increment('committedPoints', committedPoints)
+    instrumentation.extend('updateTimes', updateTimes)
+
+
+def writeForever(shard=0, shards=1):
   while reactor.running:
     try:
-      writeCachedDataPoints()
+      writeCachedDataPoints(shard, shards)
     except:
       log.err()
-
-    time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
+      time.sleep(1)
+    else:
+      # Wait for the next datapoint rather than polling. The event is cleared
+      # before checking the cache so a store() can't be missed. It is only set
+      # when the whole cache was empty, so with other shards still busy this
+      # is a 1 second back-off instead of re-counting the cache every pass.
+      MetricCache.nonEmpty.clear()
+      if shards > 1 or not MetricCache:
+        MetricCache.nonEmpty.wait(1)
+      else:
+        time.sleep(0.1)  # Avoid churning CPU when only new metrics are in the cache
 
 
 def reloadStorageSchemas():
-  global schemas
+  global schemas, schemasStamp
+  stamp = getConfigStamp(STORAGE_SCHEMAS_CONFIG)
+  if stamp == schemasStamp:
+    return
+
   try:
     schemas = loadStorageSchemas()
+    schemasStamp = stamp
   except:
     log.msg("Failed to reload storage schemas")
     log.err()
 
 
 def reloadAggregationSchemas():
-  global agg_schemas
+  global agg_schemas, agg_schemasStamp
+  stamp = getConfigStamp(STORAGE_AGGREGATION_CONFIG)
+  if stamp == agg_schemasStamp:
+    return
+
   try:
     agg_schemas = loadAggregationSchemas()
+    agg_schemasStamp = stamp
   except:
     log.msg("Failed to reload aggregation schemas")
     log.err()
 
 
 def shutdownModifyUpdateSpeed():
+    global updateBucket
     try:
         settings.MAX_UPDATES_PER_SECOND = settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN
+        updateBucket = makeUpdateBucket(settings.MAX_UPDATES_PER_SECOND)
         log.msg("Carbon shutting down.  Changed the update rate to: " + str(settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN))
     except KeyError:
         log.msg("Carbon shutting down.  Update rate not changed")
@@ -204,7 +293,14 @@ class WriterService(Service):
         self.storage_reload_task.start(60, False)
         self.aggregation_reload_task.start(60, False)
         reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
-        reactor.callInThread(writeForever)
+
+        # Writer threads never return to the pool, keep room for other users of it
+        threads = settings.WRITER_THREADS
+        if threads > 1:
+            reactor.suggestThreadPoolSize(reactor.getThreadPool().max + threads - 1)
+
+        for shard in range(threads):
+            reactor.callInThread(writeForever, shard, threads)
         Service.startService(self)
 
     def stopService(self):